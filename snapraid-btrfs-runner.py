@@ -3,75 +3,208 @@ import argparse
 import configparser
 import logging
 import logging.handlers
+import mmap
+import os
 import os.path
+import pickle
+import selectors
 import shutil
 import subprocess
 import sys
-import threading
-import time
+import tempfile
 import traceback
-from collections import Counter, defaultdict
-from io import StringIO
+from collections import deque
+from email import charset
+
+# use quoted-printable instead of the default base64 for utf-8 emails
+charset.add_charset("utf-8", charset.SHORTEST, charset.QP)
 
 # Global variables
 config = None
 email_log = None
 
+# Bump when parse_config changes, so existing config caches are re-parsed
+CONFIG_CACHE_VERSION = 1
+
+# Size of a single read from the snapraid-btrfs output pipes
+READ_SIZE = 64 * 1024
+
+# Line prefixes counted in the snapraid diff output
+DIFF_ACTIONS = {b"add": "add", b"remove": "remove",
+                b"move": "move", b"update": "update"}
+
+# Command line flags for the options passed to snapraid-btrfs and snapraid
+OPTION_FLAGS = dict((k, "--" + k) for k in
+                    ["snapper-configs", "snapper-configs-file", "pool-dir",
+                     "plan", "older-than"])
 
-def tee_log(infile, out_lines, log_level):
+
+class ConfigSection(dict):
     """
-    Create a thread that saves all the output on infile to out_lines and
-    logs every line with log_level
+    Config section that returns "" for options that are not set
     """
-    def tee_thread():
-        for line in iter(infile.readline, ""):
-            logging.log(log_level, line.rstrip())
-            out_lines.append(line)
-        infile.close()
-    t = threading.Thread(target=tee_thread)
-    t.daemon = True
-    t.start()
-    return t
+    __slots__ = ()
+
+    def __missing__(self, key):
+        return ""
+
+
+def tee_log(p, diff_counts=None):
+    """
+    Read the stdout and stderr pipes of p until EOF and log every line with
+    the OUTPUT or OUTERR level.
+    If diff_counts is given, stdout lines starting with one of DIFF_ACTIONS
+    are counted in it.
+    """
+    # logging.log would look up the root logger and check its handlers for
+    # every single line
+    log = logging.getLogger().log
+    selector = selectors.DefaultSelector()
+    for (infile, log_level) in ((p.stdout, logging.OUTPUT),
+                                (p.stderr, logging.OUTERR)):
+        os.set_blocking(infile.fileno(), False)
+        selector.register(infile, selectors.EVENT_READ,
+                          (log_level, bytearray()))
+    while selector.get_map():
+        for (key, _) in selector.select():
+            log_level, buf = key.data
+            try:
+                chunk = os.read(key.fd, READ_SIZE)
+            except BlockingIOError:
+                continue
+            if chunk:
+                buf += chunk
+                # only split up to the last newline, the rest of the buffer
+                # is an incomplete line
+                end = buf.rfind(b"\n") + 1
+                lines = bytes(buf[:end]).splitlines()
+                del buf[:end]
+            else:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                lines = bytes(buf).splitlines()
+            for line in lines:
+                if diff_counts is not None and log_level == logging.OUTPUT:
+                    (action, sep, _) = line.partition(b" ")
+                    if sep and action in DIFF_ACTIONS:
+                        diff_counts[DIFF_ACTIONS[action]] += 1
+                # Snapraid always outputs utf-8 on windows. On linux, utf-8
+                # also seems a sensible assumption.
+                log(log_level, line.decode("utf-8", "replace").rstrip())
+    selector.close()
+
+
+class RingLogHandler(logging.Handler):
+    """
+    Handler that keeps the formatted records in memory, but only up to
+    maxsize bytes of utf-8: the first and the last maxsize / 2 bytes are
+    kept and whole records from the middle are dropped.
+    A maxsize of 0 keeps everything.
+    """
+    def __init__(self, maxsize=0):
+        super().__init__()
+        self.half_size = maxsize // 2
+        self.head = []
+        self.head_size = 0
+        # set once a record did not fit into head, later records must not
+        # end up before it
+        self.head_full = False
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped_lines = 0
+        # set once anything was dropped or truncated
+        self.shortened = False
+
+    @staticmethod
+    def size(msg):
+        return len(msg) if msg.isascii() else len(msg.encode("utf-8"))
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + "\n"
+        except Exception:
+            self.handleError(record)
+            return
+        if not self.half_size:
+            self.head.append(msg)
+            return
+        size = self.size(msg)
+        if not self.head_full and self.head_size + size <= self.half_size:
+            self.head.append(msg)
+            self.head_size += size
+            return
+        self.head_full = True
+        self.tail.append((msg, size))
+        self.tail_size += size
+        while self.tail_size > self.half_size and len(self.tail) > 1:
+            (dropped, size) = self.tail.popleft()
+            self.tail_size -= size
+            self.dropped_lines += dropped.count("\n")
+            self.shortened = True
+        if self.tail_size > self.half_size:
+            self.truncate_tail()
+
+    def truncate_tail(self):
+        """
+        Shorten the single record in tail, which is bigger than maxsize / 2,
+        to its last lines that fit into maxsize / 2 bytes
+        """
+        (msg, _) = self.tail.pop()
+        data = msg.encode("utf-8")[-self.half_size:]
+        # start at the first complete line, unless not even the last line
+        # fits
+        start = data.find(b"\n") + 1
+        if start < len(data):
+            data = data[start:]
+        kept = data.decode("utf-8", "ignore")
+        self.dropped_lines += msg.count("\n") - max(kept.count("\n"), 1)
+        size = self.size(kept)
+        self.tail.append((kept, size))
+        self.tail_size = size
+        self.shortened = True
+
+    def getvalue(self):
+        """
+        Return the kept log, with a marker where records were dropped
+        """
+        head = "".join(self.head)
+        tail = "".join(msg for (msg, _) in self.tail)
+        if not self.shortened:
+            return head + tail
+        return (
+            head +
+            "[...]\n\n\n --- LOG WAS TOO BIG - {} LINES REMOVED --\n\n\n[...]".format(
+                self.dropped_lines) +
+            tail)
 
 
 def snapraid_btrfs_command(command, *, snapraid_args={}, snapraid_btrfs_args={}, allow_statuscodes=[]):
     """
     Run snapraid-btrfs command
+    Returns the counts of DIFF_ACTIONS for diff, None otherwise
     Raises subprocess.CalledProcessError if errorlevel != 0
     """
-    snapraid_btrfs_arguments = ["--quiet",
-                                "--conf", config["snapraid"]["config"],
-                                "--snapper-path", config["snapper"]["executable"],
-                                "--snapraid-path", config["snapraid"]["executable"]]
+    snapraid_btrfs_arguments = list(config["_snapraid_btrfs_command"])
     # if len(config["snapraid-btrfs"]["cleanup-algorithm"]) > 0:
     #     snapraid_btrfs_arguments.extend(["--cleanup", config["snapraid-btrfs"]["cleanup-algorithm"]])
     for (k, v) in snapraid_btrfs_args.items():
-        snapraid_btrfs_arguments.extend(["--" + k, str(v)])
+        snapraid_btrfs_arguments.extend([OPTION_FLAGS.get(k) or "--" + k, str(v)])
     if command == "cleanup":
         snapraid_arguments = []
     else:
         snapraid_arguments = ["--quiet"]
     for (k, v) in snapraid_args.items():
-        snapraid_arguments.extend(["--" + k, str(v)])
+        snapraid_arguments.extend([OPTION_FLAGS.get(k) or "--" + k, str(v)])
     p = subprocess.Popen(
-        [config["snapraid-btrfs"]["executable"]] + snapraid_btrfs_arguments + [command] + snapraid_arguments,
+        snapraid_btrfs_arguments + [command] + snapraid_arguments,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-        # Snapraid always outputs utf-8 on windows. On linux, utf-8
-        # also seems a sensible assumption.
-        encoding="utf-8",
-        errors="replace"
-    )
-    out = []
-    threads = [
-        tee_log(p.stdout, out, logging.OUTPUT),
-        tee_log(p.stderr, [], logging.OUTERR)]
-    for t in threads:
-        t.join()
+        stderr=subprocess.PIPE)
+    if command == "diff":
+        out = dict.fromkeys(DIFF_ACTIONS.values(), 0)
+    else:
+        out = None
+    tee_log(p, out)
     ret = p.wait()
-    # sleep for a while to make pervent output mixup
-    time.sleep(0.3)
     if ret == 0 or ret in allow_statuscodes:
         return out
     else:
@@ -81,32 +214,26 @@ def snapraid_btrfs_command(command, *, snapraid_args={}, snapraid_btrfs_args={},
 def send_email(success):
     import smtplib
     from email.mime.text import MIMEText
-    from email import charset
 
     if len(config["smtp"]["host"]) == 0:
         logging.error("Failed to send email because smtp host is not set")
         return
 
-    # use quoted-printable instead of the default base64
-    charset.add_charset("utf-8", charset.SHORTEST, charset.QP)
     if success:
         body = "SnapRAID job completed successfully:\n\n\n"
     else:
         body = "Error during SnapRAID job:\n\n\n"
 
-    log = email_log.getvalue()
-    maxsize = config['email'].get('maxsize', 500) * 1024
-    if maxsize and len(log) > maxsize:
-        cut_lines = log.count("\n", maxsize // 2, -maxsize // 2)
-        log = (
-            "NOTE: Log was too big for email and was shortened\n\n" +
-            log[:maxsize // 2] +
-            "[...]\n\n\n --- LOG WAS TOO BIG - {} LINES REMOVED --\n\n\n[...]".format(
-                cut_lines) +
-            log[-maxsize // 2:])
-    body += log
+    if email_log.shortened:
+        body += "NOTE: Log was too big for email and was shortened\n\n"
+    body += email_log.getvalue()
 
-    msg = MIMEText(body, "plain", "utf-8")
+    if body.isascii() and max(map(len, body.splitlines())) <= 998:
+        # 7bit, no transfer encoding needed as long as no line exceeds the
+        # smtp line length limit
+        msg = MIMEText(body, "plain", "us-ascii")
+    else:
+        msg = MIMEText(body, "plain", "utf-8")
     msg["Subject"] = config["email"]["subject"] + \
         (" SUCCESS" if success else " ERROR")
     msg["From"] = config["email"]["from"]
@@ -130,7 +257,11 @@ def send_email(success):
 
 
 def finish(is_success):
-    if ("error", "success")[is_success] in config["email"]["sendon"]:
+    if is_success:
+        notify = config["_notify_on_success"]
+    else:
+        notify = config["_notify_on_error"]
+    if notify:
         try:
             send_email(is_success)
         except Exception:
@@ -142,15 +273,71 @@ def finish(is_success):
     sys.exit(0 if is_success else 1)
 
 
-def load_config(args):
-    global config
-    parser = configparser.RawConfigParser()
-    parser.read(args.conf)
+def config_cache_key(conf):
+    """
+    Key identifying the config file contents a cache was written for
+    """
+    st = os.stat(conf)
+    # st_ctime_ns can not be set by users, it catches same-size edits that
+    # keep the mtime (e.g. touch -r or coarse timestamps)
+    return (CONFIG_CACHE_VERSION, st.st_mtime_ns, st.st_ctime_ns,
+            st.st_size, st.st_ino)
+
+
+def load_config_cache(conf, key):
+    """
+    Load the parsed config from the cache file next to conf.
+    Returns None if the cache is missing, unreadable or was not written
+    for key
+    """
+    try:
+        with open(conf + ".cache", "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            (cached_key, cached) = pickle.loads(m)
+    except Exception:
+        return None
+    if cached_key != key:
+        return None
+    return dict((x, ConfigSection(v)) for (x, v) in cached.items())
+
+
+def save_config_cache(conf, key, parsed):
+    """
+    Write the parsed config to the cache file next to conf, ignoring errors
+    """
+    cache = conf + ".cache"
+    data = pickle.dumps(
+        (key, dict((x, dict(v)) for (x, v) in parsed.items())),
+        protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        # the config contains the smtp password, mkstemp creates a new
+        # private (0600) file with a unique name
+        (fd, tmp) = tempfile.mkstemp(
+            prefix=os.path.basename(cache) + ".", suffix=".tmp",
+            dir=os.path.dirname(os.path.abspath(cache)))
+    except OSError:
+        return
+    try:
+        with open(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, cache)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def parse_config(conf):
+    parser = configparser.ConfigParser(interpolation=None,
+                                       empty_lines_in_values=False)
+    with open(conf, encoding="utf-8") as f:
+        parser.read_file(f)
     sections = ["snapraid-btrfs", "snapper", "snapraid", "logging", "email", "smtp", "scrub"]
-    config = dict((x, defaultdict(lambda: "")) for x in sections)
+    parsed = dict((x, ConfigSection()) for x in sections)
     for section in parser.sections():
         for (k, v) in parser.items(section):
-            config[section][k] = v.strip()
+            parsed[section][k] = v.strip()
 
     int_options = [
         ("snapraid", "deletethreshold"), ("logging", "maxsize"),
@@ -158,27 +345,36 @@ def load_config(args):
     ]
     for section, option in int_options:
         try:
-            config[section][option] = int(config[section][option])
+            parsed[section][option] = int(parsed[section][option])
         except ValueError:
-            config[section][option] = 0
+            parsed[section][option] = 0
 
-    try:
-        config["snapraid-btrfs"]["cleanup"]
-    except KeyError:
-        config["snapraid-btrfs"]["cleanup"] = ""
-
-    config["smtp"]["ssl"] = (config["smtp"]["ssl"].lower() == "true")
-    config["smtp"]["tls"] = (config["smtp"]["tls"].lower() == "true")
-    config["scrub"]["enabled"] = (config["scrub"]["enabled"].lower() == "true")
-    config["email"]["short"] = (config["email"]["short"].lower() == "true")
-    config["snapraid"]["touch"] = (config["snapraid"]["touch"].lower() == "true")
-    config["snapraid-btrfs"]["pool"] = (config["snapraid-btrfs"]["pool"].lower() == "true")
-    config["snapraid-btrfs"]["cleanup"] = (config["snapraid-btrfs"]["cleanup"].lower() == "true")
+    bool_options = [
+        ("smtp", "ssl"), ("smtp", "tls"), ("scrub", "enabled"),
+        ("email", "short"), ("snapraid", "touch"),
+        ("snapraid-btrfs", "pool"), ("snapraid-btrfs", "cleanup"),
+    ]
+    for section, option in bool_options:
+        parsed[section][option] = (parsed[section][option].lower() == "true")
 
     # Migration
-    if config["scrub"]["percentage"]:
-        config["scrub"]["plan"] = config["scrub"]["percentage"]
+    if parsed["scrub"]["percentage"]:
+        parsed["scrub"]["plan"] = parsed["scrub"]["percentage"]
+
+    return parsed
 
+
+def load_config(args):
+    global config
+    # stat before parsing, so a config changed while parsing is not cached
+    # under the new key
+    cache_key = config_cache_key(args.conf)
+    config = load_config_cache(args.conf, cache_key)
+    if config is None:
+        config = parse_config(args.conf)
+        save_config_cache(args.conf, cache_key, config)
+
+    # Command line overrides are applied after caching
     if args.scrub is not None:
         config["scrub"]["enabled"] = args.scrub
 
@@ -194,6 +390,25 @@ def load_config(args):
     if args.cleanup is not None:
         config["snapraid-btrfs"]["cleanup"] = args.cleanup
 
+    # Email is the only notification
+    config["_notify_on_success"] = "success" in config["email"]["sendon"]
+    config["_notify_on_error"] = "error" in config["email"]["sendon"]
+
+    # Search the executables in PATH only once. The path is empty
+    # if the executable was not found
+    config["_executables"] = {}
+    for section in ["snapraid-btrfs", "snapper", "snapraid"]:
+        path = shutil.which(config[section]["executable"])
+        config["_executables"][section] = os.path.abspath(path) if path else ""
+
+    # snapraid-btrfs executable and the arguments shared by all its commands
+    config["_snapraid_btrfs_command"] = (
+        config["_executables"]["snapraid-btrfs"],
+        "--quiet",
+        "--conf", config["snapraid"]["config"],
+        "--snapper-path", config["_executables"]["snapper"],
+        "--snapraid-path", config["_executables"]["snapraid"])
+
 
 def setup_logger():
     log_format = logging.Formatter(
@@ -219,13 +434,12 @@ def setup_logger():
 
     if config["email"]["sendon"]:
         global email_log
-        email_log = StringIO()
-        email_logger = logging.StreamHandler(email_log)
-        email_logger.setFormatter(log_format)
+        email_log = RingLogHandler(max(config["email"]["maxsize"], 0) * 1024)
+        email_log.setFormatter(log_format)
         if config["email"]["short"]:
             # Don't send programm stdout in email
-            email_logger.setLevel(logging.INFO)
-        root_logger.addHandler(email_logger)
+            email_log.setLevel(logging.INFO)
+        root_logger.addHandler(email_log)
 
 
 def main():
@@ -281,7 +495,7 @@ def run():
     logging.info("Run started")
     logging.info("=" * 60)
 
-    if shutil.which(config["snapraid"]["executable"]) is None:
+    if not config["_executables"]["snapraid"]:
         logging.error("The configured snapraid executable \"{}\" does not "
                         "exist or is not a file".format(
                             config["snapraid"]["executable"]))
@@ -290,11 +504,11 @@ def run():
         logging.error("Snapraid config does not exist at " +
                         config["snapraid"]["config"])
         finish(False)
-    if shutil.which(config["snapraid-btrfs"]["executable"]) is None:
+    if not config["_executables"]["snapraid-btrfs"]:
         logging.error("Snapraid-btrfs executable does not exist at " +
                         config["snapraid-btrfs"]["executable"])
         finish(False)
-    if shutil.which(config["snapper"]["executable"]) is None:
+    if not config["_executables"]["snapper"]:
         logging.error("Snapper executable does not exist at " +
                         config["snapper"]["executable"])
         finish(False)
@@ -313,12 +527,9 @@ def run():
         logging.info("*" * 60)
 
     logging.info("Running diff...")
-    diff_out = snapraid_btrfs_command("diff", snapraid_btrfs_args = snapraid_btrfs_args_extend, allow_statuscodes=[2])
+    diff_results = snapraid_btrfs_command("diff", snapraid_btrfs_args = snapraid_btrfs_args_extend, allow_statuscodes=[2])
     logging.info("*" * 60)
 
-    diff_results = Counter(line.split(" ")[0] for line in diff_out)
-    diff_results = dict((x, diff_results[x]) for x in
-                        ["add", "remove", "move", "update"])
     logging.info(("Diff results: {add} added,  {remove} removed,  " +
                     "{move} moved,  {update} modified").format(**diff_results))
 